@@ -1,9 +1,31 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 import io
 from datetime import datetime
 import json
 import time
+import os
+import hashlib
+import tempfile
+from http.cookiejar import DefaultCookiePolicy
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_CONCURRENT_REQUESTS = 4  # Solicitudes simultáneas por defecto
+MAX_CONCURRENT_REQUESTS = 10  # Máximo por usuario
+# Conexiones reutilizables de la sesión HTTP compartida por todos los usuarios
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 5 * MAX_CONCURRENT_REQUESTS))
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 60  # Segundos
+# Caché en disco de audios ya generados. Se puede borrar en cualquier momento;
+# además se poda tras cada generación según antigüedad y tamaño total.
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", ".tts_cache")
+TTS_CACHE_MAX_AGE = int(os.environ.get("TTS_CACHE_MAX_AGE", 7 * 24 * 3600))  # Segundos
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", 500 * 1024 * 1024))
+AUDIO_MEMORY_CACHE_ENTRIES = 200  # Fragmentos recientes que se mantienen en memoria
+AUDIO_MEMORY_CACHE_TTL = 3600  # Segundos
+
+_COMMA_SPACE = ", "
 
 def split_text_for_tts(text, max_chars=250):
     """
@@ -16,37 +38,55 @@ def split_text_for_tts(text, max_chars=250):
     paragraphs = [p.strip() for p in text.split('\n') if p.strip()]
     fragments = []
     current_fragment = ""
+    sep = _COMMA_SPACE
+    sep_len = len(sep)
+    clause_limit = max_chars - sep_len
     
     for paragraph in paragraphs:
         if len(paragraph) <= max_chars:
             fragments.append(paragraph)
             continue
             
-        sentences = [s.strip() + '.' for s in paragraph.replace('. ', '.').split('.') if s.strip()]
-        
-        for sentence in sentences:
+        # Una sola pasada: strip() ya elimina el espacio tras cada punto
+        for sentence in paragraph.split('.'):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            sentence += '.'
+            
             if len(sentence) > max_chars:
-                parts = sentence.split(',')
                 current_part = ""
+                current_len = 0
                 
-                for part in parts:
+                for part in sentence.split(','):
                     part = part.strip()
-                    if len(current_part) + len(part) + 2 <= max_chars:
-                        current_part = (current_part + ", " + part).strip(", ")
+                    if not part:
+                        continue
+                    part_len = len(part)
+                    if current_len + part_len <= clause_limit:
+                        if current_part:
+                            current_part = f"{current_part}{sep}{part}"
+                            current_len += part_len + sep_len
+                        else:
+                            current_part = part
+                            current_len = part_len
                     else:
                         if current_part:
                             fragments.append(current_part + ".")
                         current_part = part
+                        current_len = part_len
                 
                 if current_part:
                     fragments.append(current_part + ".")
                     
-            elif len(current_fragment + sentence) > max_chars:
+            elif len(current_fragment) + len(sentence) > max_chars:
                 if current_fragment:
-                    fragments.append(current_fragment.strip())
+                    fragments.append(current_fragment)
                 current_fragment = sentence
+            elif current_fragment:
+                current_fragment = f"{current_fragment} {sentence}"
             else:
-                current_fragment = (current_fragment + " " + sentence).strip()
+                current_fragment = sentence
         
         if current_fragment:
             fragments.append(current_fragment)
@@ -57,11 +97,26 @@ def split_text_for_tts(text, max_chars=250):
     
     return fragments
 
-def generate_audio(text, api_key, voice_id, stability, similarity, use_speaker_boost, model_id="eleven_multilingual_v2"):
+@st.cache_resource
+def get_session():
     """
-    Genera audio usando la API de Eleven Labs
+    Sesión HTTP para reutilizar las conexiones TCP/TLS con la API de Eleven Labs.
+    Es única en el servidor y la comparten todos los usuarios, reruns e hilos:
+    no guarda cookies y la API key viaja en las cabeceras de cada solicitud.
     """
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}"
+    session = requests.Session()
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    return session
+
+def generate_audio_stream(session, text, api_key, voice_id, stability, similarity, use_speaker_boost, model_id="eleven_multilingual_v2", chunk_size=4096):
+    """
+    Genera audio usando el endpoint de streaming de Eleven Labs.
+    Devuelve los bytes MP3 a medida que se sintetizan.
+    Reintenta con espera exponencial si la API responde 429 (rate limit).
+    """
+    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream"
     
     headers = {
         "Accept": "audio/mpeg",
@@ -80,20 +135,119 @@ def generate_audio(text, api_key, voice_id, stability, similarity, use_speaker_b
         }
     }
     
+    for attempt in range(MAX_RETRIES):
+        response = session.post(url, json=data, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+        if response.status_code != 429 or attempt == MAX_RETRIES - 1:
+            break
+        response.close()
+        time.sleep(2 ** attempt)
+    
+    with response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            yield chunk
+
+@st.cache_data(show_spinner=False, max_entries=AUDIO_MEMORY_CACHE_ENTRIES, ttl=AUDIO_MEMORY_CACHE_TTL)
+def _synthesize(_session, text, api_key, voice_id, stability, similarity, use_speaker_boost, model_id):
+    """
+    Obtiene el audio de un fragmento, consultando primero la caché en disco.
+    Los errores se propagan para que no queden guardados en la caché.
+    """
+    payload = {
+        "text": text,
+        "voice_id": voice_id,
+        "model_id": model_id,
+        "stability": stability,
+        "similarity_boost": similarity,
+        "use_speaker_boost": use_speaker_boost
+    }
+    key = hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    path = os.path.join(TTS_CACHE_DIR, f"{key}.mp3")
+    
+    # La caché en disco es opcional: si no se puede leer, se usa la API
     try:
-        response = requests.post(url, json=data, headers=headers)
-        if response.status_code == 200:
-            return response.content
-        else:
-            st.error(f"Error en la generación de audio: {response.status_code}")
-            return None
+        with open(path, "rb") as f:
+            cached = f.read()
+        if cached:
+            os.utime(path)  # Marca el uso para la poda por antigüedad
+            return cached
+    except OSError:
+        pass
+    
+    buffer = io.BytesIO()
+    for chunk in generate_audio_stream(_session, text, api_key, voice_id, stability,
+                                       similarity, use_speaker_boost, model_id):
+        buffer.write(chunk)
+    audio = buffer.getvalue()
+    if not audio:
+        # Se lanza para no guardar en caché ni descartar el fragmento en silencio
+        raise ValueError("la API devolvió un audio vacío")
+    
+    # Escritura atómica: otro hilo puede estar generando el mismo fragmento.
+    # Un fallo al guardar no debe descartar el audio ya generado.
+    tmp_path = None
+    try:
+        os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=TTS_CACHE_DIR, suffix=".part", delete=False) as f:
+            tmp_path = f.name
+            f.write(audio)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+    return audio
+
+def prune_tts_cache():
+    """
+    Elimina de la caché en disco los audios más antiguos que TTS_CACHE_MAX_AGE
+    y, si aún se supera TTS_CACHE_MAX_BYTES, los menos usados recientemente
+    """
+    try:
+        entries = [entry for entry in os.scandir(TTS_CACHE_DIR) if entry.is_file()]
+    except OSError:
+        return
+    
+    now = time.time()
+    files = []
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in files:
+        if now - mtime <= TTS_CACHE_MAX_AGE and total <= TTS_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+def generate_audio(session, text, api_key, voice_id, stability, similarity, use_speaker_boost, model_id="eleven_multilingual_v2"):
+    """
+    Genera el audio completo de un fragmento usando la API de Eleven Labs.
+    Devuelve (audio, error) sin escribir en la interfaz, ya que se ejecuta
+    en los hilos del pool.
+    """
+    try:
+        return _synthesize(session, text, api_key, voice_id, stability,
+                           similarity, use_speaker_boost, model_id), None
+    except requests.HTTPError as e:
+        return None, f"Error en la generación de audio: {e.response.status_code}"
     except Exception as e:
-        st.error(f"Error en la solicitud: {str(e)}")
-        return None
+        return None, f"Error en la solicitud: {str(e)}"
 
-def get_available_voices(api_key):
+@st.cache_data(ttl=3600, show_spinner=False)
+def _fetch_voices(api_key):
     """
-    Obtiene la lista de voces disponibles de Eleven Labs
+    Consulta las voces de Eleven Labs (se cachea durante una hora)
     """
     url = "https://api.elevenlabs.io/v1/voices"
     headers = {
@@ -101,12 +255,17 @@ def get_available_voices(api_key):
         "xi-api-key": api_key
     }
     
+    response = get_session().get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()
+    voices = response.json()["voices"]
+    return {voice["name"]: voice["voice_id"] for voice in voices}
+
+def get_available_voices(api_key):
+    """
+    Obtiene la lista de voces disponibles de Eleven Labs
+    """
     try:
-        response = requests.get(url, headers=headers)
-        if response.status_code == 200:
-            voices = response.json()["voices"]
-            return {voice["name"]: voice["voice_id"] for voice in voices}
-        return {}
+        return _fetch_voices(api_key)
     except:
         return {}
 
@@ -173,6 +332,14 @@ def main():
                                           value=True,
                                           help="Mejora la claridad de la voz")
     
+    # Solicitudes en paralelo
+    st.sidebar.markdown("### ⚡ Rendimiento")
+    max_workers = st.sidebar.number_input("Solicitudes simultáneas",
+                                          min_value=1,
+                                          max_value=MAX_CONCURRENT_REQUESTS,
+                                          value=DEFAULT_CONCURRENT_REQUESTS,
+                                          help="Fragmentos generados a la vez. No debe superar el límite de concurrencia de tu plan de Eleven Labs")
+    
     # Obtener voces disponibles si hay API key
     if api_key:
         voices = get_available_voices(api_key)
@@ -219,26 +386,59 @@ def main():
         progress_bar = st.progress(0)
         status_text = st.empty()
         
+        # Generar los fragmentos en paralelo reutilizando la conexión HTTP
+        session = get_session()
+        results = [None] * len(fragments)
+        completed = [False] * len(fragments)
+        status_text.text(f"Generando {len(fragments)} audios...")
+        
+        # Un hueco por fragmento para mostrar cada audio en orden en cuanto
+        # estén listos él y todos los anteriores
+        placeholders = [st.empty() for _ in fragments]
         all_audios = []
-        for i, fragment in enumerate(fragments, 1):
-            status_text.text(f"Generando audio {i}/{len(fragments)}...")
-            audio_content = generate_audio(
-                fragment, 
-                api_key, 
-                voice_id, 
-                stability,
-                similarity,
-                use_speaker_boost
-            )
-            
-            if audio_content:
-                all_audios.append(audio_content)
-                with st.expander(f"Audio fragmento {i}"):
-                    st.audio(audio_content, format="audio/mp3")
-                    st.write(fragment)
+        next_to_render = 0
+        
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = {
+                executor.submit(
+                    generate_audio,
+                    session,
+                    fragment,
+                    api_key,
+                    voice_id,
+                    stability,
+                    similarity,
+                    use_speaker_boost
+                ): i
+                for i, fragment in enumerate(fragments)
+            }
             
-            progress_bar.progress(i/len(fragments))
-            time.sleep(1)  # Pequeña pausa para evitar límites de rate
+            for done, future in enumerate(as_completed(futures), 1):
+                index = futures[future]
+                results[index] = future.result()
+                completed[index] = True
+                
+                while next_to_render < len(fragments) and completed[next_to_render]:
+                    audio_content, error = results[next_to_render]
+                    if error:
+                        placeholders[next_to_render].error(f"Fragmento {next_to_render + 1}: {error}")
+                    elif audio_content:
+                        all_audios.append(audio_content)
+                        with placeholders[next_to_render].container():
+                            with st.expander(f"Audio fragmento {next_to_render + 1}"):
+                                st.audio(audio_content, format="audio/mp3")
+                                st.write(fragments[next_to_render])
+                    next_to_render += 1
+                
+                status_text.text(f"Generando audio {done}/{len(fragments)}...")
+                progress_bar.progress(done/len(fragments))
+        except BaseException:
+            # Rerun o Stop de Streamlit: no esperar ni generar los fragmentos pendientes
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+        prune_tts_cache()
         
         status_text.text("¡Proceso completado!")
         